@@ -0,0 +1,46 @@
+'''
+Checks MOBILE_OPS against the operators of real i2rnetv3 mobile exports.
+Exits with 1 on drift, --update prints the regenerated constant instead.
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from models.imagenet.i2rnetv3 import MOBILE_OPS, export_mobile, i2rnetv3
+
+parser = argparse.ArgumentParser(description='Check the i2rnetv3 mobile operator list')
+parser.add_argument('--width-mult', type=float, default=1.0, help='MobileNet model width multiplier.')
+parser.add_argument('--update', action='store_true',
+                    help='print MOBILE_OPS generated from the exports')
+args = parser.parse_args()
+
+# export both memory formats, channels_last adds the input/head contiguous calls
+ops = set()
+tmpdir = tempfile.mkdtemp()
+for channels_last in (False, True):
+    model = i2rnetv3(width_mult=args.width_mult, channels_last=channels_last)
+    path = os.path.join(tmpdir, 'i2rnetv3.ptl')
+    ops.update(torch.jit.export_opnames(export_mobile(model, path)))
+    os.remove(path)
+os.rmdir(tmpdir)
+
+if args.update:
+    print('MOBILE_OPS = (')
+    for op in sorted(ops):
+        print("    '{}',".format(op))
+    print(')')
+    sys.exit(0)
+
+missing = sorted(ops - set(MOBILE_OPS))
+stale = sorted(set(MOBILE_OPS) - ops)
+if missing:
+    print('used by the export but missing from MOBILE_OPS: ' + ', '.join(missing))
+if stale:
+    print('listed in MOBILE_OPS but not used by the export: ' + ', '.join(stale))
+if missing or stale:
+    sys.exit(1)
+print('MOBILE_OPS matches the exported operators')
@@ -6,11 +6,54 @@ arXiv preprint arXiv:1801.04381.
 import from https://github.com/tonylins/pytorch-mobilenet-v2
 """
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.intrinsic.qat as nniqat
+import torch.ao.nn.qat as nnqat
+import torch.ao.quantization as tq
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import (QConfig, QuantStub, DeQuantStub,
+                                   FakeQuantize, MovingAverageMinMaxObserver,
+                                   MovingAveragePerChannelMinMaxObserver,
+                                   disable_observer, fuse_modules,
+                                   fuse_modules_qat, get_default_qconfig,
+                                   get_default_qat_qconfig, prepare,
+                                   convert)
+from torch.jit import Final
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.mobile_optimizer import optimize_for_mobile
+import copy
 import math
+import warnings
+from collections import OrderedDict
 
 __all__ = ['i2rnetv3',]
 
+# symmetric int8 fake-quant for prepare_qat, the scheme TensorRT requires for
+# explicit Q/DQ quantization
+TENSORRT_QAT_QCONFIG = QConfig(
+    activation=FakeQuantize.with_args(observer=MovingAverageMinMaxObserver,
+                                      quant_min=-128, quant_max=127,
+                                      dtype=torch.qint8,
+                                      qscheme=torch.per_tensor_symmetric),
+    weight=FakeQuantize.with_args(observer=MovingAveragePerChannelMinMaxObserver,
+                                  quant_min=-128, quant_max=127,
+                                  dtype=torch.qint8,
+                                  qscheme=torch.per_channel_symmetric))
+
+# root operators of the float lite-interpreter model written by export_mobile
+# (NCHW and channels_last), the op list for a selective libtorch build:
+#   SELECTED_OP_LIST=i2rnetv3.yaml scripts/build_pytorch_android.sh arm64-v8a
+# check_mobile_ops.py compares it against real exports, --update regenerates it
+MOBILE_OPS = (
+    'aten::add.Tensor',
+    'aten::contiguous',
+    'aten::mean.dim',
+    'prepacked::conv2d_clamp_run',
+    'prepacked::linear_clamp_run',
+)
+
 
 def _make_divisible(v, divisor, min_value=None):
     """
@@ -32,6 +75,97 @@ def _make_divisible(v, divisor, min_value=None):
     return new_v
 
 
+# setting of inverted residual blocks
+I2RNET_CFGS = (
+    # t, c, n, s
+    (2,  96, 1, 2),
+    (4,  96, 2, 1),
+    (4, 128, 1, 1),
+    (4, 128, 2, 2),
+    (4, 256, 1, 1),
+    (4, 256, 2, 2),
+    (4, 384, 4, 1),
+    (4, 640, 1, 1),
+    (4, 640, 2, 2),
+    (4,1280, 2, 1),
+)
+
+I2RNETV2_CFGS = (
+    # t, c, n, s
+    (2,  96, 1, 2, 0),
+    (4,  96, 1, 1, 0),
+    (4, 128, 3, 2, 0),
+    (4, 256, 2, 2, 0),
+    (4, 384, 2, 1, 0),
+    (4, 384, 2, 1, 1),
+    (4, 640, 2, 2, 0),
+    (4,1280, 2, 1, 0),
+)
+
+
+def _channel_widths(cfgs, width_mult):
+    """
+    Returns the stem, per-stage and last channel counts for width_mult.
+    """
+    divisor = 4 if width_mult == 0.1 else 8
+    stages = tuple(_make_divisible(cfg[1] * width_mult, divisor) for cfg in cfgs)
+    return (_make_divisible(32 * width_mult, divisor),) + stages + (_make_divisible(stages[-1], 4),)
+
+
+# channel counts for the usual width multipliers, resolved once at import
+WIDTH_MULTS = (0.35, 0.5, 0.75, 1.0, 1.3, 1.4)
+I2RNET_CHANNELS_BY_WIDTH = {w: _channel_widths(I2RNET_CFGS, w) for w in WIDTH_MULTS}
+I2RNETV2_CHANNELS_BY_WIDTH = {w: _channel_widths(I2RNETV2_CFGS, w) for w in WIDTH_MULTS}
+
+
+def _conv_bn_pairs(seq):
+    """
+    Returns the names of every Conv2d directly followed by a BatchNorm2d in
+    seq, in the form expected by fuse_modules.
+    """
+    children = list(seq.named_children())
+    return [[name, next_name]
+            for (name, m), (next_name, next_m) in zip(children, children[1:])
+            if isinstance(m, nn.Conv2d) and isinstance(next_m, nn.BatchNorm2d)]
+
+
+def _fill_flat(params, fill):
+    """
+    Fills one flat buffer covering all params with fill and copies the
+    slices back, so the init kernel runs once for the whole group.
+    """
+    if not params:
+        return
+    flat = torch.empty(sum(p.numel() for p in params),
+                       dtype=params[0].dtype, device=params[0].device)
+    fill(flat)
+    for p, chunk in zip(params, flat.split([p.numel() for p in params])):
+        p.copy_(chunk.view_as(p))
+
+
+def _init_weights_grouped(modules):
+    # group the tensors by init so there is one RNG call per distinct std
+    # instead of one per layer
+    normal, ones, zeros = OrderedDict(), [], []
+    for m in modules:
+        if isinstance(m, nn.Conv2d):
+            n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+            normal.setdefault(math.sqrt(2. / n), []).append(m.weight)
+            if m.bias is not None:
+                zeros.append(m.bias)
+        elif isinstance(m, nn.BatchNorm2d):
+            ones.append(m.weight)
+            zeros.append(m.bias)
+        elif isinstance(m, nn.Linear):
+            normal.setdefault(0.01, []).append(m.weight)
+            zeros.append(m.bias)
+    with torch.no_grad():
+        for std, params in normal.items():
+            _fill_flat(params, lambda t: t.normal_(0, std))
+        _fill_flat(ones, lambda t: t.fill_(1))
+        _fill_flat(zeros, lambda t: t.zero_())
+
+
 def conv_3x3_bn(inp, oup, stride):
     return nn.Sequential(
         nn.Conv2d(inp, oup, 3, stride, 1, bias=False),
@@ -82,112 +216,217 @@ def BlockTransition(inp, oup, stride=1, relu=True):
     return conv
 
 class I2RBlock(nn.Module):
+    identity: Final[bool]
+    id_tensor_idx: Final[int]
+    expand_ratio: Final[int]
+
     def __init__(self, inp, oup, stride, expand_ratio, transition=False):
         super(I2RBlock, self).__init__()
         assert stride in [1, 2]
 
-        hidden_dim = inp // expand_ratio
-
         #self.relu = nn.ReLU6(inplace=True)
         self.identity = False
         self.expand_ratio = expand_ratio
         self.div = 1
         self.id_tensor_idx = inp // self.div
         if expand_ratio == 2:
-            self.conv = nn.Sequential(
-                # dw
-                nn.Conv2d(inp, inp, 3, 1, 1, groups=inp, bias=False),
-                nn.BatchNorm2d(inp),
-                nn.ReLU6(inplace=True),
-                # pw-linear
-                nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                # pw-linear
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-                nn.ReLU6(inplace=True),
-                # dw
-                nn.Conv2d(oup, oup, 3, stride, 1, groups=oup, bias=False),
-                nn.BatchNorm2d(oup),
-            )
+            self.conv = self._build_conv(inp, oup, stride, inp // expand_ratio, True, True)
         elif inp != oup and stride == 1 or transition == True:
-            hidden_dim = oup // expand_ratio
-            self.conv = nn.Sequential(
-                # pw-linear
-                nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                # pw-linear
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-                nn.ReLU6(inplace=True),
-            )
+            self.conv = self._build_conv(inp, oup, stride, oup // expand_ratio, False, False)
         elif inp != oup and stride == 2:
-            hidden_dim = oup // expand_ratio
-            self.conv = nn.Sequential(
-                # pw-linear
-                nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                # pw-linear
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-                nn.ReLU6(inplace=True),
-                # dw
-                nn.Conv2d(oup, oup, 3, stride, 1, groups=oup, bias=False),
-                nn.BatchNorm2d(oup),
-            )
+            self.conv = self._build_conv(inp, oup, stride, oup // expand_ratio, False, True)
         else:
+            # inp == oup, the depthwise convs keep stride 1 on this path
             self.identity = True
-            self.conv = nn.Sequential(
-                # dw
-                nn.Conv2d(inp, inp, 3, 1, 1, groups=oup, bias=False),
-                nn.BatchNorm2d(inp),
-                nn.ReLU6(inplace=True),
-                # pw
-                nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                #nn.ReLU6(inplace=True),
-                # pw
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-                nn.ReLU6(inplace=True),
-                # dw
-                nn.Conv2d(oup, oup, 3, 1, 1, groups=oup, bias=False),
-                nn.BatchNorm2d(oup),
-            )
+            # with div == 1 the shortcut covers every output channel, so it
+            # is a plain residual add
+            assert self.id_tensor_idx == oup
+            # quantized tensors need the add as a module to carry its own
+            # scale, only identity blocks have one so no observer sits idle
+            self.skip_add = FloatFunctional()
+            # float eval may add the shortcut into the conv output buffer
+            self.inplace_add = True
+            self.conv = self._build_conv(inp, oup, 1, oup // expand_ratio, True, True)
+
+        # grouped convs here are depthwise, groups must follow the input
+        # channels for the backends' depthwise kernels to be picked
+        for m in self.conv.modules():
+            if isinstance(m, nn.Conv2d) and m.groups > 1:
+                assert m.groups == m.in_channels, 'depthwise conv groups != in_channels'
+
+    @classmethod
+    def _build_conv(cls, inp, oup, stride, hidden_dim, use_dw_pre, use_dw_post):
+        """
+        Builds the dw_pre -> pw1 -> pw2 -> dw_post body shared by every branch,
+        pw1 is linear and dw_post is linear and carries the stride.
+        """
+        stages = OrderedDict()
+        if use_dw_pre:
+            stages['dw_pre'] = cls._dw(inp, 1, relu=True)
+        stages['pw1'] = cls._pw(inp, hidden_dim, relu=False)
+        stages['pw2'] = cls._pw(hidden_dim, oup, relu=True)
+        if use_dw_post:
+            stages['dw_post'] = cls._dw(oup, stride, relu=False)
+        return nn.Sequential(stages)
+
+    @staticmethod
+    def _dw(inp, stride, relu):
+        layers = [
+            nn.Conv2d(inp, inp, 3, stride, 1, groups=inp, bias=False),
+            nn.BatchNorm2d(inp),
+        ]
+        if relu:
+            layers.append(nn.ReLU6(inplace=True))
+        return nn.Sequential(*layers)
+
+    @staticmethod
+    def _pw(inp, oup, relu):
+        layers = [
+            nn.Conv2d(inp, oup, 1, 1, 0, bias=False),
+            nn.BatchNorm2d(oup),
+        ]
+        if relu:
+            layers.append(nn.ReLU6(inplace=True))
+        return nn.Sequential(*layers)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the block was split into stages keep all
+        # layers flat in ``conv``, map conv.N onto conv.<stage>.<idx>
+        legacy = prefix + 'conv.'
+        keys = [k for k in state_dict
+                if k.startswith(legacy) and k[len(legacy)].isdigit()]
+        if keys:
+            layers = ['{}{}.{}'.format(legacy, name, idx)
+                      for name, stage in self.conv.named_children()
+                      for idx, _ in stage.named_children()]
+            for k in keys:
+                idx, param = k[len(legacy):].split('.', 1)
+                state_dict[layers[int(idx)] + '.' + param] = state_dict.pop(k)
+        super(I2RBlock, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        if self.identity:
-            # id_tensor = x
-            # id_tensor = x[:,:1,:,:]
-            id_tensor = x[:,:self.id_tensor_idx,:,:]
         out = self.conv(x)
 
         if self.identity:
-            # out = out + id_tensor
-            # out[:,:1,:,:] = out[:,:1,:,:] + id_tensor
-            out[:,:self.id_tensor_idx,:,:] = out[:,:self.id_tensor_idx,:,:] + id_tensor
-            return out
+            # out-of-place add keeps the residual fusable and lets the memory
+            # format propagate through the block
+            if self.training or not self.inplace_add:
+                return self.skip_add.add(out, x)
+            # out is this block's own result, reuse it instead of
+            # allocating another activation-sized tensor
+            return out.add_(x)
         else:
             return out
 
 
-class I2RNet(nn.Module):
+class _I2RNetBase(nn.Module):
+    """
+    Forward pass and deployment helpers shared by I2RNet and I2RNetV2,
+    subclasses build features and classifier in __init__.
+    """
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.quant(x)
+        x = self.features(x)
+        x = self.dequant(x)
+        #x = self.conv(x)
+        # global average pooling as a plain spatial mean, already (N, C)
+        x = x.mean([2, 3])
+        if self.channels_last:
+            # give the classifier GEMM a plain row-major (N, C) input
+            x = x.contiguous()
+        x = F.dropout(x, 0.2, self.training)
+        x = self.classifier(x)
+        return x
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the classifier used to be Sequential(Dropout, Linear)
+        legacy = prefix + 'classifier.1.'
+        for k in [k for k in state_dict if k.startswith(legacy)]:
+            state_dict[prefix + 'classifier.' + k[len(legacy):]] = state_dict.pop(k)
+        super(_I2RNetBase, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def to_memory_format(self, memory_format=torch.channels_last):
+        """
+        Moves the parameters to memory_format and converts inputs to it in
+        forward. channels_last (NHWC) suits the depthwise and pointwise convs
+        on XNNPACK/QNNPACK and cuDNN.
+        """
+        self.channels_last = memory_format == torch.channels_last
+        return self.to(memory_format=memory_format)
+
+    def to_half(self):
+        """
+        Casts the model to fp16 for GPU training/inference, BatchNorm stays
+        in fp32 for stable statistics (cuDNN takes fp16 inputs with fp32 BN
+        parameters). For mixed precision without touching the modules, run
+        forward under torch.autocast('cuda', dtype=torch.bfloat16) instead.
+        """
+        self.half()
+        for m in self.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.float()
+        return self
+
+    def fuse_model(self):
+        """
+        Fuses every Conv2d + BatchNorm2d pair in place. In eval mode the BN is
+        folded into the conv weights, in train mode the QAT fused modules are
+        used instead. ReLU6 is not a fusable pattern and is left as is.
+        """
+        fuse = fuse_modules_qat if self.training else fuse_modules
+        for m in list(self.modules()):
+            if isinstance(m, nn.Sequential):
+                pairs = _conv_bn_pairs(m)
+                if pairs:
+                    fuse(m, pairs, inplace=True)
+        return self
+
+    def fold_bn(self):
+        """
+        Folds every BatchNorm2d into the preceding Conv2d weights and replaces
+        it with an Identity. Unlike fuse_model this does not go through the
+        quantization fuser, the model must be in eval mode.
+        """
+        for m in list(self.modules()):
+            if isinstance(m, nn.Sequential):
+                for conv_name, bn_name in _conv_bn_pairs(m):
+                    conv = fuse_conv_bn_eval(getattr(m, conv_name), getattr(m, bn_name))
+                    setattr(m, conv_name, conv)
+                    setattr(m, bn_name, nn.Identity())
+        return self
+
+    def prepare_qat(self, backend='qnnpack', qconfig=None):
+        """
+        Fuses the model and inserts fake-quant modules for quantization aware
+        training of the features, the classifier stays float. After
+        fine-tuning, call convert on the model in eval mode to get the int8
+        model.
+        """
+        torch.backends.quantized.engine = backend
+        self.train()
+        self.fuse_model()
+        self._set_qconfig(qconfig or get_default_qat_qconfig(backend))
+        tq.prepare_qat(self, inplace=True)
+        return self
+
+    def _set_qconfig(self, qconfig):
+        self.qconfig = qconfig
+        # dequant sits before pooling, so the head gets float features and
+        # must stay a float Linear
+        self.classifier.qconfig = None
+        _disable_inplace_add(self)
+
+    def _initialize_weights(self):
+        _init_weights_grouped(self.modules())
+
+class I2RNet(_I2RNetBase):
+    cfgs = I2RNET_CFGS
+
     def __init__(self, num_classes=1000, width_mult=1.):
         super(I2RNet, self).__init__()
-        # setting of inverted residual blocks
-        self.cfgs = [
-            # t, c, n, s
-            [2,  96, 1, 2],
-            [4,  96, 2, 1],
-            [4, 128, 1, 1],
-            [4, 128, 2, 2],
-            [4, 256, 1, 1],
-            [4, 256, 2, 2],
-            [4, 384, 4, 1],
-            [4, 640, 1, 1],
-            [4, 640, 2, 2],
-            [4,1280, 2, 1],
-        ]
         #self.cfgs = [
         #    # t, c, n, s
         #    [1,  16, 1, 1],
@@ -199,13 +438,14 @@ class I2RNet(nn.Module):
         #    [4, 320, 1, 1],
         #]
 
+        channels = I2RNET_CHANNELS_BY_WIDTH.get(width_mult) or _channel_widths(self.cfgs, width_mult)
+
         # building first layer
-        input_channel = _make_divisible(32 * width_mult, 4 if width_mult == 0.1 else 8)
+        input_channel = channels[0]
         layers = [conv_3x3_bn(3, input_channel, 2)]
         # building inverted residual blocks
         block = I2RBlock
-        for t, c, n, s in self.cfgs:
-            output_channel = _make_divisible(c * width_mult, 4 if width_mult == 0.1 else 8)
+        for (t, c, n, s), output_channel in zip(self.cfgs, channels[1:-1]):
             layers.append(block(input_channel, output_channel, s, t))
             input_channel = output_channel
             for i in range(n-1):
@@ -213,53 +453,20 @@ class I2RNet(nn.Module):
                 input_channel = output_channel
         self.features = nn.Sequential(*layers)
         # building last several layers
-        input_channel = output_channel
-        output_channel = _make_divisible(input_channel, 4) # if width_mult == 0.1 else 8) if width_mult > 1.0 else input_channel
-        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
-        self.classifier = nn.Sequential(
-                nn.Dropout(0.2),
-                nn.Linear(output_channel, num_classes)
-                )
+        output_channel = channels[-1]
+        self.classifier = nn.Linear(output_channel, num_classes)
+        self.channels_last = False
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
 
         self._initialize_weights()
 
-    def forward(self, x):
-        x = self.features(x)
-        #x = self.conv(x)
-        x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
-        x = self.classifier(x)
-        return x
 
-    def _initialize_weights(self):
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
-                if m.bias is not None:
-                    m.bias.data.zero_()
-            elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
-            elif isinstance(m, nn.Linear):
-                m.weight.data.normal_(0, 0.01)
-                m.bias.data.zero_()
-
-class I2RNetV2(nn.Module):
+class I2RNetV2(_I2RNetBase):
+    cfgs = I2RNETV2_CFGS
+
     def __init__(self, num_classes=1000, width_mult=1.):
         super(I2RNetV2, self).__init__()
-        # setting of inverted residual blocks
-        self.cfgs = [
-            # t, c, n, s
-            [2,  96, 1, 2, 0],
-            [4,  96, 1, 1, 0],
-            [4, 128, 3, 2, 0],
-            [4, 256, 2, 2, 0],
-            [4, 384, 2, 1, 0],
-            [4, 384, 2, 1, 1],
-            [4, 640, 2, 2, 0],
-            [4,1280, 2, 1, 0],
-        ]
         #self.cfgs = [
         #    # t, c, n, s
         #    [1,  16, 1, 1],
@@ -271,13 +478,14 @@ class I2RNetV2(nn.Module):
         #    [4, 320, 1, 1],
         #]
 
+        channels = I2RNETV2_CHANNELS_BY_WIDTH.get(width_mult) or _channel_widths(self.cfgs, width_mult)
+
         # building first layer
-        input_channel = _make_divisible(32 * width_mult, 4 if width_mult == 0.1 else 8)
+        input_channel = channels[0]
         layers = [conv_3x3_bn(3, input_channel, 2)]
         # building inverted residual blocks
         block = I2RBlock
-        for t, c, n, s, b in self.cfgs:
-            output_channel = _make_divisible(c * width_mult, 4 if width_mult == 0.1 else 8)
+        for (t, c, n, s, b), output_channel in zip(self.cfgs, channels[1:-1]):
             layers.append(block(input_channel, output_channel, s, t, b == 1))
             input_channel = output_channel
             for i in range(n-1):
@@ -285,37 +493,150 @@ class I2RNetV2(nn.Module):
                 input_channel = output_channel
         self.features = nn.Sequential(*layers)
         # building last several layers
-        input_channel = output_channel
-        output_channel = _make_divisible(input_channel, 4) # if width_mult == 0.1 else 8) if width_mult > 1.0 else input_channel
-        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
-        self.classifier = nn.Sequential(
-                nn.Dropout(0.2),
-                nn.Linear(output_channel, num_classes)
-                )
+        output_channel = channels[-1]
+        self.classifier = nn.Linear(output_channel, num_classes)
+        self.channels_last = False
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
 
         self._initialize_weights()
 
-    def forward(self, x):
-        x = self.features(x)
-        #x = self.conv(x)
-        x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
-        x = self.classifier(x)
-        return x
 
-    def _initialize_weights(self):
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
-                if m.bias is not None:
-                    m.bias.data.zero_()
-            elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
-            elif isinstance(m, nn.Linear):
-                m.weight.data.normal_(0, 0.01)
-                m.bias.data.zero_()
+def _disable_inplace_add(model):
+    # route the residual add through skip_add, where observers and quantized
+    # adds see it and export graphs keep the out-of-place aten::add
+    for m in model.modules():
+        if isinstance(m, I2RBlock) and m.identity:
+            m.inplace_add = False
+
+def quantize_static(model, calib_data, backend='qnnpack'):
+    """
+    Post-training int8 quantization of an I2RNet for the given quantized
+    engine (qnnpack for ARM mobile, fbgemm for x86). The model is fused,
+    calibrated on the input batches of calib_data and converted in place.
+    The features run in int8, pooling and the classifier stay float.
+    :param model: I2RNet or I2RNetV2
+    :param calib_data: iterable of input batches used to collect activation ranges
+    :param backend: quantized engine
+    :return: the converted model
+    """
+    torch.backends.quantized.engine = backend
+    model.eval()
+    model.fuse_model()
+    model._set_qconfig(get_default_qconfig(backend))
+    prepare(model, inplace=True)
+    with torch.no_grad():
+        for x in calib_data:
+            model(x)
+    convert(model, inplace=True)
+    return model
+
+def _prepare_export(model):
+    # export from a copy, folding BN and switching to eval must not leak
+    # into a model that is still being trained
+    model = copy.deepcopy(model)
+    model.eval()
+    model.fold_bn()
+    # inplace ops get in the way of the freezing/folding passes, they only
+    # save memory in eager execution
+    for m in model.modules():
+        if isinstance(m, nn.ReLU6):
+            m.inplace = False
+    _disable_inplace_add(model)
+    return model
+
+def script_model(model):
+    """
+    Scripts and freezes a copy of the model for TorchScript inference.
+    Freezing folds the BN constants and drops the dropout branch from the
+    graph; the caller's model is not modified.
+    """
+    return torch.jit.freeze(torch.jit.script(_prepare_export(model)))
+
+def export_mobile(model, path, backend='CPU', optimization_blocklist=None,
+                  op_list_path=None):
+    """
+    Scripts the model and saves it for the PyTorch lite interpreter.
+    optimize_for_mobile freezes the scripted module, which folds the
+    remaining BN constants and removes dropout, then fuses conv/clamp and
+    prepacks the conv weights for XNNPACK. The export runs on a copy, the
+    caller's model is not modified.
+    :param model: float or quantized I2RNet / I2RNetV2
+    :param path: output .ptl file
+    :param backend: 'CPU' or 'Vulkan'
+    :param optimization_blocklist: set of MobileOptimizerType passes to skip,
+        keep INSERT_FOLD_PREPACK_OPS out of it for XNNPACK prepacking
+    :param op_list_path: if given, the model's root operators are written
+        there as a yaml list for a SELECTED_OP_LIST libtorch build
+    :return: the optimized scripted module
+    """
+    scripted = torch.jit.script(_prepare_export(model))
+    optimized = optimize_for_mobile(scripted, optimization_blocklist, backend=backend)
+    # every float conv should now run as prepacked::conv2d_clamp_run with its
+    # weights already in the XNNPACK layout
+    if backend == 'CPU' and 'aten::conv2d' in str(optimized.graph):
+        warnings.warn('some convolutions were not prepacked for XNNPACK')
+    ops = sorted(torch.jit.export_opnames(optimized))
+    if op_list_path is not None:
+        with open(op_list_path, 'w') as f:
+            f.writelines('- {}\n'.format(op) for op in ops)
+    optimized._save_for_lite_interpreter(path)
+    return optimized
+
+def _fold_qat_conv_bn(model):
+    """
+    Replaces every QAT ConvBn2d with a QAT Conv2d that holds the BN-folded
+    weight and bias and keeps the trained weight fake-quant. In eval mode a
+    ConvBn2d fake-quantizes weight * bn_scale, divides the conv output by
+    bn_scale and applies the BN, so the folded conv computes the same
+    result without the rescaling ops.
+    """
+    for parent in list(model.modules()):
+        for name, m in list(parent.named_children()):
+            # exact type, ConvBnReLU2d subclasses ConvBn2d
+            if type(m) is not nniqat.ConvBn2d:
+                continue
+            conv = nn.Conv2d(m.in_channels, m.out_channels, m.kernel_size,
+                             m.stride, m.padding, m.dilation, m.groups,
+                             bias=m.bias is not None, padding_mode=m.padding_mode)
+            conv.weight, conv.bias = m.weight, m.bias
+            conv = fuse_conv_bn_eval(conv, m.bn)
+            qat_conv = nnqat.Conv2d(m.in_channels, m.out_channels, m.kernel_size,
+                                    m.stride, m.padding, m.dilation, m.groups,
+                                    bias=True, padding_mode=m.padding_mode,
+                                    qconfig=m.qconfig)
+            qat_conv.weight, qat_conv.bias = conv.weight, conv.bias
+            qat_conv.weight_fake_quant = m.weight_fake_quant
+            if hasattr(m, 'activation_post_process'):
+                # prepare observed the ConvBn2d output through a forward hook
+                qat_conv = nn.Sequential(qat_conv, m.activation_post_process)
+            setattr(parent, name, qat_conv)
+    return model
+
+def export_onnx(model, sample, path, opset_version=17):
+    """
+    Exports the model to ONNX for TensorRT. BN is folded into the convs
+    first, so every dw/pw conv is directly followed by its clamp, the
+    DW -> act -> PW -> act pattern TensorRT fuses into a DepSepConvolution
+    kernel. A model prepared with prepare_qat(qconfig=TENSORRT_QAT_QCONFIG)
+    has its QAT ConvBn2d modules folded the same way and exports its
+    fake-quant modules as QuantizeLinear/DequantizeLinear pairs, giving
+    Q/DQ -> Conv -> act for int8 engines. The export runs on a copy, the
+    caller's model is not modified.
+    :param model: float or QAT-prepared I2RNet / I2RNetV2
+    :param sample: example input batch
+    :param path: output .onnx file
+    :param opset_version: ONNX opset, per-channel Q/DQ needs 13 or later
+    """
+    model = _prepare_export(model)
+    # keep the scales learned during QAT
+    model.apply(disable_observer)
+    _fold_qat_conv_bn(model)
+    torch.onnx.export(model, sample, path,
+                      opset_version=opset_version,
+                      do_constant_folding=True,
+                      input_names=['input'],
+                      output_names=['output'])
 
 def i2rnet(**kwargs):
     """
@@ -323,8 +644,21 @@ def i2rnet(**kwargs):
     """
     return I2RNet(**kwargs)
 
-def i2rnetv3(**kwargs):
+def i2rnetv3(use_compile=False, channels_last=False, **kwargs):
     """
     Constructs a MobileNet V2 model
+    :param use_compile: wrap the model with torch.compile (Inductor), the
+        state_dict keys of the wrapper carry an ``_orig_mod.`` prefix
+    :param channels_last: run the model in NHWC memory format
     """
-    return I2RNetV2(**kwargs)
+    model = I2RNetV2(**kwargs)
+    if channels_last:
+        model = model.to_memory_format(torch.channels_last)
+    if use_compile:
+        # max-autotune settings passed per model, mode and options can't be
+        # combined; nd tiling tiles the NHWC pointwise epilogues over both dims
+        model = torch.compile(model, fullgraph=True,
+                              options={'max_autotune': True,
+                                       'triton.cudagraphs': True,
+                                       'triton.prefer_nd_tiling': True})
+    return model